@@ -1,19 +1,220 @@
+import io
 import os
-import json
+import gzip
+import re
+import time
+import hashlib
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from xml.sax.saxutils import escape as xml_escape
+import orjson
 import streamlit as st
-from openai import OpenAI
-from docx import Document
-from docx.shared import Pt
 
 # =========================================================
 # Helpers
 # =========================================================
+# Well above the ~5 KB static prompt prefix, so only genuinely large payloads
+# (long transcripts) are compressed.
+GZIP_MIN_BYTES = 32 * 1024
+
+class GzipRequestTransport:
+    """httpx transport wrapper that gzips large JSON request bodies.
+
+    OpenAI does not document gzip request bodies, so if the API rejects the
+    encoding (415, or a 400 whose body mentions it) the request is resent
+    uncompressed and compression is turned off for the rest of the process.
+    Other errors, e.g. context_length_exceeded, are returned as-is.
+
+    Duck-typed rather than subclassing httpx.BaseTransport so httpx stays a
+    lazy import.
+    """
+
+    def __init__(self, transport, min_bytes: int = GZIP_MIN_BYTES):
+        self._transport = transport
+        self._min_bytes = min_bytes
+        self._enabled = True
+
+    def _maybe_compress(self, request):
+        import httpx
+
+        if not self._enabled or "content-encoding" in request.headers:
+            return request
+        if not request.headers.get("content-type", "").startswith("application/json"):
+            return request
+        try:
+            content = request.content
+        except httpx.RequestNotRead:
+            return request  # streaming body (e.g. multipart upload)
+        if len(content) < self._min_bytes:
+            return request
+
+        body = gzip.compress(content, compresslevel=5)
+        headers = request.headers.copy()
+        headers["Content-Encoding"] = "gzip"
+        headers["Content-Length"] = str(len(body))
+        return httpx.Request(
+            request.method, request.url, headers=headers, content=body, extensions=request.extensions
+        )
+
+    @staticmethod
+    def _encoding_rejected(response) -> bool:
+        if response.status_code == 415:
+            return True
+        if response.status_code != 400:
+            return False
+        response.read()  # error bodies are small; the caller can still read it
+        body = response.text.lower()
+        return "gzip" in body or "content-encoding" in body or "decompress" in body
+
+    def handle_request(self, request):
+        compressed = self._maybe_compress(request)
+        response = self._transport.handle_request(compressed)
+        if compressed is not request and self._encoding_rejected(response):
+            response.close()
+            self._enabled = False
+            response = self._transport.handle_request(request)
+        return response
+
+    def close(self):
+        self._transport.close()
+
+    def __enter__(self):
+        self._transport.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._transport.__exit__(*exc_info)
+
+@st.cache_resource
+def _build_client(api_key: str, compress_requests: bool = False):
+    # One client per key for the whole server process, so the HTTP/2 connection
+    # pool (and its TLS sessions) survive reruns.
+    # openai/httpx are imported here so cold starts don't pay for them.
+    import httpx
+    from openai import OpenAI, DefaultHttpxClient
+
+    # Pool settings live on the transport: httpx ignores Client(http2=, limits=)
+    # once a custom transport is passed.
+    transport = httpx.HTTPTransport(
+        http2=True,
+        retries=2,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+    )
+    if compress_requests:
+        transport = GzipRequestTransport(transport)
+    http_client = DefaultHttpxClient(transport=transport)
+    # Retries are handled by RequestThrottle.call, not the SDK.
+    return OpenAI(api_key=api_key, http_client=http_client, max_retries=0)
+
 def get_client():
     api_key = st.secrets.get("OPENAI_API_KEY", None) or os.getenv("OPENAI_API_KEY")
     if not api_key:
         st.error("Missing OPENAI_API_KEY. Add it in Streamlit Secrets.")
         st.stop()
-    return OpenAI(api_key=api_key)
+    return _build_client(api_key, st.session_state.get("gzip_requests", False))
+
+MAX_CONCURRENT_REQUESTS = 10
+MAX_REQUESTS_PER_MINUTE = 500
+MAX_RETRY_AFTER_SECONDS = 60
+
+def _is_retryable(exc: BaseException) -> bool:
+    import openai
+    if isinstance(exc, openai.RateLimitError):
+        # An exhausted quota is a 429 too, but waiting will not fix it.
+        return getattr(exc, "code", None) != "insufficient_quota"
+    return isinstance(exc, (openai.APIConnectionError, openai.InternalServerError))
+
+def _retry_after_seconds(exc: BaseException):
+    response = getattr(exc, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            value = headers["retry-after"]
+            try:
+                return float(value)
+            except ValueError:
+                retry_at = parsedate_to_datetime(value)
+                return retry_at.timestamp() - time.time()
+    except (TypeError, ValueError):
+        pass
+    return None
+
+class RequestThrottle:
+    """Caps in-flight OpenAI calls and keeps them under a requests-per-minute budget."""
+
+    def __init__(self, max_concurrent: int = MAX_CONCURRENT_REQUESTS,
+                 max_rpm: int = MAX_REQUESTS_PER_MINUTE):
+        self.max_rpm = max_rpm
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        self._sent = deque()  # monotonic send times within the last minute
+        self._lock = threading.Lock()
+
+    def _wait_for_rate_budget(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                while self._sent and now - self._sent[0] >= 60:
+                    self._sent.popleft()
+                if len(self._sent) < self.max_rpm:
+                    self._sent.append(now)
+                    return
+                delay = 60 - (now - self._sent[0])
+            time.sleep(delay)
+
+    @contextmanager
+    def slot(self):
+        with self._slots:
+            self._wait_for_rate_budget()
+            yield
+
+    def _with_retries(self, send):
+        # 429s, connection errors and 5xx are retried with jittered exponential
+        # backoff, or after the server's Retry-After when it sends one.
+        from tenacity import Retrying, retry_if_exception, stop_after_attempt, wait_exponential_jitter
+
+        backoff = wait_exponential_jitter(initial=1, max=30)
+
+        def wait(retry_state):
+            retry_after = _retry_after_seconds(retry_state.outcome.exception())
+            if retry_after is not None and retry_after >= 0:
+                return min(retry_after, MAX_RETRY_AFTER_SECONDS)
+            return backoff(retry_state)
+
+        for attempt in Retrying(
+            stop=stop_after_attempt(5),
+            wait=wait,
+            retry=retry_if_exception(_is_retryable),
+            reraise=True,
+        ):
+            with attempt:
+                return send()
+
+    def call(self, fn, *args, **kwargs):
+        def send():
+            with self.slot():
+                return fn(*args, **kwargs)
+        return self._with_retries(send)
+
+    @contextmanager
+    def stream(self, fn, *args, **kwargs):
+        """Like call(), but holds the concurrency slot until the stream is closed."""
+        with self._slots:
+            def send():
+                self._wait_for_rate_budget()
+                return fn(*args, **kwargs)
+            stream = self._with_retries(send)
+            with stream:
+                yield stream
+
+@st.cache_resource
+def get_throttle() -> RequestThrottle:
+    return RequestThrottle()
 
 def get_model():
     return st.secrets.get("OPENAI_MODEL", "gpt-4o-mini")
@@ -22,7 +223,8 @@ def clean_text(x: str) -> str:
     return (x or "").strip()
 
 def build_inputs(payload: dict) -> str:
-    return json.dumps(payload, ensure_ascii=False, indent=2)
+    # orjson emits compact UTF-8 JSON; pretty-printing only adds billed prompt tokens.
+    return orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS).decode()
 
 DISCOVERY_SYSTEM = """You are a senior management consultant.
 Your job: convert messy discovery notes into a premium, neutral, executive-ready "Discovery Intelligence Report".
@@ -36,7 +238,10 @@ Rules:
 - If user content contains sensitive details, do not invent names or specifics.
 """
 
-DISCOVERY_USER_TEMPLATE = """Create a Discovery Intelligence Report from the inputs.
+# Everything static goes into one system message so it forms a shared prompt
+# prefix (>1024 tokens, the minimum for OpenAI prompt caching); only the
+# per-client inputs are sent in the user message.
+DISCOVERY_USER_TEMPLATE_STATIC = """Create a Discovery Intelligence Report from the inputs in the user message.
 
 OUTPUT FORMAT (Markdown):
 1. Title block (client name if provided; otherwise "Client"; date placeholder; meeting type)
@@ -70,92 +275,565 @@ OUTPUT FORMAT (Markdown):
    - What we did today (discovery)
    - Proposed next step (ONLY: "alignment workshop / diagnostic deep-dive" style, not a solution)
 
-INPUTS:
-{inputs_json}
+HOW TO READ THE INPUTS:
+- The inputs arrive as a JSON object with these fields:
+  - client_name, meeting_type, project_name: use them in the title block; "Client" means no name was given.
+  - transcript_or_notes: raw transcript or rough notes. Treat it as the primary source of evidence.
+  - structured_inputs: answers captured by the consultant, one field per topic. Empty strings mean "not provided".
+  - report_constraints: flags that control the report (see below).
+- When the transcript and a structured field disagree, report both views neutrally and add the conflict to Open Questions.
+- Never treat an empty field as evidence of absence. Write "Not provided" or "Unknown" instead.
+- Speaker labels, timestamps and filler words in transcripts are noise; do not reproduce them.
+
+REPORT CONSTRAINTS:
+- no_solutions = true: never recommend actions, vendors, tools, technologies, frameworks or implementation steps.
+  Describe the situation, pressures and risks only.
+- include_open_questions = false: omit section 9 entirely and renumber the following section.
+- include_open_questions = true: section 9 must contain at least one question per group where information is missing.
+
+WRITING STYLE:
+- Write for a C-level reader who has five minutes. Lead each section with the most important point.
+- Use short sentences and plain business English. Avoid jargon, buzzwords and filler.
+- Keep a neutral, non-judgemental tone. Attribute opinions ("Stakeholders describe...", "Notes indicate...").
+- Do not speculate about individuals' motives or competence. Describe observable behaviours and structures.
+- Never invent numbers, dates, names, budgets or quotes. Paraphrase evidence rather than quoting verbatim.
+- Prefer bullets of one line each. Keep paragraphs to three sentences or fewer.
+
+FORMATTING RULES:
+- Output Markdown only. Do not wrap the report in a code fence.
+- Use "#" for the report title, "##" for numbered sections and "###" for sub-sections.
+- Use "-" for bullets. Do not nest bullets more than one level deep.
+- Render matrices and tables as ASCII tables inside a fenced code block so they survive export.
+- Keep ASCII tables under 100 characters wide and give every column a header.
+- Use "Unknown", "Not confirmed" or "Not provided" consistently; do not mix other placeholders.
+- Do not add a preamble, closing remarks or commentary about these instructions.
+
+QUALITY CHECKS BEFORE ANSWERING:
+- Every section from the output format is present and in order (subject to report constraints).
+- No sentence recommends, proposes or implies a solution.
+- Every claim can be traced to the inputs; anything else is marked as Unknown.
+- Risks each have a statement, a trigger and a consequence.
+- The Executive Narrative Map reads as a story: problem, then pressure, then consequence.
+- Stakeholders are described by role or department, never by personal characteristics.
+- The Meeting Close Summary is consistent with the rest of the report and adds no new facts.
+- Headings, numbering and placeholders follow the formatting rules exactly.
 """
 
-def generate_report(payload: dict) -> str:
-    client = get_client()
+DISCOVERY_PROMPT_PREFIX = DISCOVERY_SYSTEM + "\n\n" + DISCOVERY_USER_TEMPLATE_STATIC
+PROMPT_CACHE_KEY = "discovery-v1"
+
+class ReportCache:
+    """Exact-match cache of finished reports, keyed on (model, inputs_json).
+
+    Used instead of st.cache_data so a miss can stream tokens into the page:
+    st.cache_data cannot replay elements drawn into a placeholder created
+    outside the cached function.
+    """
+
+    def __init__(self, ttl: float = 3600, max_entries: int = 128):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, report = entry
+            if time.monotonic() - stored_at > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return report
+
+    def put(self, key, report: str):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), report)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+@st.cache_resource
+def get_report_cache() -> ReportCache:
+    return ReportCache()
+
+def _report_request(model: str, inputs_json: str) -> dict:
+    # Request body shared by the streaming call and the Batch API.
+    return {
+        "model": model,
+        "input": [
+            {"role": "system", "content": DISCOVERY_PROMPT_PREFIX},
+            {"role": "user", "content": f"INPUTS:\n{inputs_json}"},
+        ],
+        "temperature": 0.3,
+        "prompt_cache_key": PROMPT_CACHE_KEY,
+    }
+
+class ReportGenerationError(RuntimeError):
+    """The API ended a report without producing one."""
+
+class ReportIncompleteError(ReportGenerationError):
+    """The report stream stopped early; `report` holds the partial text."""
+
+    def __init__(self, reason: str, report: str = ""):
+        super().__init__(f"The report is incomplete ({reason}). Shorten the inputs or regenerate.")
+        self.reason = reason
+        self.report = report
+
+def _stream_report_deltas(client, model: str, inputs_json: str, outcome: dict):
+    # Yields text deltas; records how the response ended in `outcome`.
+    body = _report_request(model, inputs_json)
+    # Sent via extra_body so older SDKs without the keyword still work.
+    extra_body = {"prompt_cache_key": body.pop("prompt_cache_key")}
+    # create(stream=True) sends the request up front, so opening it can be retried.
+    with get_throttle().stream(client.responses.create, **body, stream=True, extra_body=extra_body) as stream:
+        for event in stream:
+            if event.type == "response.output_text.delta":
+                yield event.delta
+            elif event.type == "response.completed":
+                outcome["status"] = "completed"
+            elif event.type == "response.incomplete":
+                details = getattr(event.response, "incomplete_details", None)
+                outcome["status"] = "incomplete"
+                outcome["reason"] = getattr(details, "reason", None) or "unknown reason"
+            elif event.type == "response.failed":
+                error = getattr(event.response, "error", None)
+                raise ReportGenerationError(getattr(error, "message", None) or "The model failed to produce a report.")
+            elif event.type == "error":
+                raise ReportGenerationError(getattr(event, "message", None) or "The report stream returned an error.")
+
+def generate_report(payload: dict, stream_to=None) -> str:
     model = get_model()
     inputs_json = build_inputs(payload)
-    user_prompt = DISCOVERY_USER_TEMPLATE.format(inputs_json=inputs_json)
+    key = (model, inputs_json)
 
-    resp = client.responses.create(
-        model=model,
-        input=[
-            {"role": "system", "content": DISCOVERY_SYSTEM},
-            {"role": "user", "content": user_prompt},
-        ],
-        temperature=0.3,
+    cache = get_report_cache()
+    report = cache.get(key)
+    if report is None:
+        outcome = {}
+        deltas = _stream_report_deltas(get_client(), model, inputs_json, outcome)
+        if stream_to is not None:
+            report = stream_to.write_stream(deltas)
+        else:
+            report = "".join(deltas)
+        if not isinstance(report, str):
+            report = ""  # write_stream returns a list when nothing was streamed
+
+        # Only completed, non-empty reports are cached.
+        if outcome.get("status") == "incomplete":
+            raise ReportIncompleteError(outcome["reason"], report)
+        if outcome.get("status") != "completed":
+            raise ReportGenerationError("The report stream ended before the response completed.")
+        if not report.strip():
+            raise ReportGenerationError("The model returned an empty report.")
+        cache.put(key, report)
+    return report
+
+def generate_report_variants(payload: dict, n_variants: int = 3) -> list:
+    # The Responses API has no `n`, so variants go through Chat Completions,
+    # which samples all choices from a single prompt prefill.
+    body = _report_request(get_model(), build_inputs(payload))
+    resp = get_throttle().call(
+        get_client().chat.completions.create,
+        model=body["model"],
+        messages=body["input"],
+        temperature=0.8,  # higher than the single report so drafts differ
+        n=n_variants,
+        extra_body={"prompt_cache_key": body["prompt_cache_key"]},
     )
-    return resp.output_text
+    return [choice.message.content or "" for choice in resp.choices]
+
+def _response_body_text(body: dict) -> str:
+    # Batch output holds raw Responses JSON, which has no output_text helper.
+    parts = []
+    for item in body.get("output", []):
+        if item.get("type") != "message":
+            continue
+        for content in item.get("content", []):
+            if content.get("type") == "output_text":
+                parts.append(content.get("text", ""))
+    return "".join(parts)
+
+class BatchJob:
+    """One submission to the OpenAI Batch API, polled from a background thread."""
+
+    POLL_SECONDS = 15
+    MAX_POLL_ERRORS = 5
+    TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+    def __init__(self, client, model: str, items: list):
+        # items: (label, inputs_json) per queued payload; custom_id is the index.
+        self.client = client
+        self.model = model
+        self.items = items
+        # Resolved here, not on the polling thread.
+        self.cache = get_report_cache()
+        self.throttle = get_throttle()
+        self.batch_id = None
+        self.status = "preparing"
+        self.error = ""
+        self.results = {}
+        self.failures = {}
+
+    def submit(self):
+        lines = [
+            orjson.dumps({
+                "custom_id": str(i),
+                "method": "POST",
+                "url": "/v1/responses",
+                "body": _report_request(self.model, inputs_json),
+            })
+            for i, (_, inputs_json) in enumerate(self.items)
+        ]
+        batch_file = self.throttle.call(
+            self.client.files.create,
+            file=("discovery_batch.jsonl", b"\n".join(lines)),
+            purpose="batch",
+        )
+        batch = self.throttle.call(
+            self.client.batches.create,
+            input_file_id=batch_file.id,
+            endpoint="/v1/responses",
+            completion_window="24h",
+        )
+        self.batch_id = batch.id
+        self.status = batch.status
+        threading.Thread(target=self._poll, daemon=True).start()
+
+    def _poll(self):
+        # A polling error says nothing about the batch itself, which keeps
+        # running server-side: record it, keep the last known status, and retry
+        # on the next tick until MAX_POLL_ERRORS in a row.
+        errors_in_a_row = 0
+        while True:
+            try:
+                batch = self.throttle.call(self.client.batches.retrieve, self.batch_id)
+                if batch.status in self.TERMINAL_STATUSES:
+                    for file_id in (batch.output_file_id, batch.error_file_id):
+                        if file_id:
+                            self._collect(file_id)
+                    self.status = batch.status
+                    self.error = ""
+                    return
+                self.status = batch.status
+                self.error = ""
+                errors_in_a_row = 0
+            except Exception as e:
+                errors_in_a_row += 1
+                self.error = str(e)
+                if errors_in_a_row >= self.MAX_POLL_ERRORS:
+                    return
+            time.sleep(self.POLL_SECONDS)
+
+    def _collect(self, file_id: str):
+        # Fill local dicts and publish them with one assignment each, so the
+        # script thread never iterates a dict this thread is growing.
+        results, failures = dict(self.results), dict(self.failures)
+        content = self.throttle.call(self.client.files.content, file_id)
+        for line in content.text.splitlines():
+            if not line.strip():
+                continue
+            row = orjson.loads(line)
+            custom_id = row["custom_id"]
+            response = row.get("response") or {}
+            body = response.get("body") or {}
+            # HTTP 200 rows can still hold an incomplete or failed response.
+            if response.get("status_code") == 200 and body.get("status") == "completed":
+                report = _response_body_text(body)
+                results[custom_id] = report
+                self.cache.put((self.model, self.items[int(custom_id)][1]), report)
+            elif response.get("status_code") == 200:
+                reason = (body.get("incomplete_details") or body.get("error") or {})
+                failures[custom_id] = f"response {body.get('status')}: {reason}"
+            else:
+                failures[custom_id] = str(row.get("error") or body)
+        self.results = results
+        self.failures = failures
+
+    def progress_rows(self) -> list:
+        rows = []
+        for i, (label, _) in enumerate(self.items):
+            custom_id = str(i)
+            if custom_id in self.results:
+                state = "done"
+            elif custom_id in self.failures:
+                state = f"failed: {self.failures[custom_id]}"
+            else:
+                state = self.status
+            rows.append({"custom_id": custom_id, "client": label, "status": state})
+        return rows
+
+@st.cache_resource
+def _get_embedding_encoding():
+    import tiktoken
+    return tiktoken.get_encoding("cl100k_base")  # text-embedding-3-* tokenizer
+
+class SemanticCache:
+    """Reuses a prior report when a new payload embeds close enough to an old one.
+
+    One instance per browser session (see get_semantic_cache), so reports are
+    never shared between users.
+    """
+
+    EMBEDDING_TOKEN_LIMIT = 8191
+
+    def __init__(self, threshold: float = 0.97, max_entries: int = 256,
+                 embedding_model: str = "text-embedding-3-small"):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.embedding_model = embedding_model
+        self._embeddings = None  # (N, D) matrix of L2-normalized rows
+        self._reports = []
+        self._partitions = []  # partition key per row; see _partition
+        self._lock = threading.Lock()
+
+    def _truncate(self, text: str) -> str:
+        # The embedding endpoint rejects inputs over its token limit; the head of
+        # the content is enough to match near-duplicate regenerations.
+        # Byte-level BPE: a token never covers less than one UTF-8 byte.
+        if len(text.encode("utf-8")) <= self.EMBEDDING_TOKEN_LIMIT:
+            return text
+        tokens = _get_embedding_encoding().encode(text)
+        if len(tokens) <= self.EMBEDDING_TOKEN_LIMIT:
+            return text
+        return _get_embedding_encoding().decode(tokens[:self.EMBEDDING_TOKEN_LIMIT])
+
+    # numpy is imported lazily: the cache is opt-in and numpy is slow to load.
+    def _embed(self, client, text: str):
+        import numpy as np
+
+        text = self._truncate(text)
+        resp = get_throttle().call(client.embeddings.create, model=self.embedding_model, input=text)
+        vec = np.asarray(resp.data[0].embedding, dtype=np.float32)
+        return vec / (np.linalg.norm(vec) or 1.0)
+
+    @staticmethod
+    def _embedding_text(payload: dict) -> str:
+        # Only what the user wrote; the fixed JSON skeleton would otherwise
+        # dominate the embedding of a short payload.
+        parts = [f"{k}: {v}" for k, v in payload["structured_inputs"].items() if v]
+        if payload["transcript_or_notes"]:
+            parts.append(payload["transcript_or_notes"])
+        return "\n".join(parts)
+
+    @staticmethod
+    def _partition(model: str, payload: dict) -> tuple:
+        # Only payloads with the same model, meeting metadata and report
+        # constraints may share a report; embeddings alone barely see a flipped flag.
+        constraints = tuple(sorted(payload["report_constraints"].items()))
+        return (model, payload["client_name"], payload["project_name"], payload["meeting_type"], constraints)
+
+    def lookup(self, partition: tuple, query):
+        import numpy as np
+
+        with self._lock:
+            rows = [i for i, p in enumerate(self._partitions) if p == partition]
+            if not rows:
+                return None
+            scores = self._embeddings[rows] @ query
+            best = int(np.argmax(scores))
+            if scores[best] >= self.threshold:
+                return self._reports[rows[best]]
+        return None
+
+    def add(self, partition: tuple, query, report: str):
+        import numpy as np
+
+        with self._lock:
+            if self._embeddings is None:
+                self._embeddings = query[np.newaxis, :]
+            else:
+                self._embeddings = np.vstack([self._embeddings, query])
+            self._reports.append(report)
+            self._partitions.append(partition)
+            # FIFO eviction
+            overflow = len(self._reports) - self.max_entries
+            if overflow > 0:
+                self._embeddings = self._embeddings[overflow:]
+                del self._reports[:overflow]
+                del self._partitions[:overflow]
+
+    def get_or_generate(self, payload: dict, stream_to=None) -> str:
+        model = get_model()
+        # An exact-match hit needs no embeddings call.
+        report = get_report_cache().get((model, build_inputs(payload)))
+        if report is not None:
+            return report
+
+        partition = self._partition(model, payload)
+        query = self._embed(get_client(), self._embedding_text(payload))
+        report = self.lookup(partition, query)
+        if report is None:
+            report = generate_report(payload, stream_to=stream_to)
+            self.add(partition, query, report)
+        return report
+
+def get_semantic_cache() -> SemanticCache:
+    # Session-scoped: the reports it holds are confidential client material.
+    if "semantic_cache" not in st.session_state:
+        st.session_state["semantic_cache"] = SemanticCache()
+    return st.session_state["semantic_cache"]
+
+HEADING_RE = re.compile(r"^(#{1,3}) (.*)$")
+BULLET_RE = re.compile(r"^\s*[-*] (.*)$")
+FENCE_RE = re.compile(r"^\s*```")
+
+# Paragraphs are emitted as raw WordprocessingML and parsed in one go, which
+# skips python-docx's per-call style lookup and element re-parenting.
+W_NS = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+_EMPTY_P = "<w:p/>"
+_PLAIN_P = "<w:p><w:r>{}</w:r></w:p>"
+_STYLED_P = '<w:p><w:pPr><w:pStyle w:val="{}"/></w:pPr><w:r>{}</w:r></w:p>'
+# Fenced blocks (the prompt asks for ASCII tables in them) keep their column
+# alignment in a tight monospace paragraph.
+_CODE_P = (
+    '<w:p><w:pPr><w:spacing w:before="0" w:after="0"/></w:pPr>'
+    '<w:r><w:rPr><w:rFonts w:ascii="Consolas" w:hAnsi="Consolas" w:cs="Consolas"/>'
+    '<w:sz w:val="18"/></w:rPr>{}</w:r></w:p>'
+)
+
+def _oxml_text(text: str) -> str:
+    # Same tab handling as python-docx's add_paragraph.
+    return '<w:tab/>'.join(
+        f'<w:t xml:space="preserve">{xml_escape(part)}</w:t>' for part in text.split("\t")
+    )
+
+def _md_line_to_oxml(raw: str) -> str:
+    line = raw.rstrip()
+    if not line.strip():
+        return _EMPTY_P
+
+    m = HEADING_RE.match(line)
+    if m:
+        return _STYLED_P.format(f"Heading{len(m.group(1))}", _oxml_text(m.group(2)))
+
+    m = BULLET_RE.match(line)
+    if m:
+        return _STYLED_P.format("ListBullet", _oxml_text(m.group(1)))
+    return _PLAIN_P.format(_oxml_text(line))
+
+def _md_to_oxml(md_text: str):
+    in_fence = False
+    for raw in md_text.splitlines():
+        if FENCE_RE.match(raw):
+            in_fence = not in_fence
+            continue
+        yield _CODE_P.format(_oxml_text(raw.rstrip())) if in_fence else _md_line_to_oxml(raw)
 
 def markdown_to_docx(md_text: str) -> bytes:
+    from docx import Document
+    from docx.oxml import parse_xml
+    from docx.shared import Pt
+
     doc = Document()
     style = doc.styles["Normal"]
     style.font.name = "Calibri"
     style.font.size = Pt(11)
 
-    for raw in md_text.splitlines():
-        line = raw.rstrip()
-
-        if not line.strip():
-            doc.add_paragraph("")
-            continue
+    paragraphs = "".join(_md_to_oxml(md_text))
+    fragment = parse_xml(f'<w:body xmlns:w="{W_NS}">{paragraphs}</w:body>')
 
-        if line.startswith("### "):
-            doc.add_heading(line.replace("### ", ""), level=3)
-        elif line.startswith("## "):
-            doc.add_heading(line.replace("## ", ""), level=2)
-        elif line.startswith("# "):
-            doc.add_heading(line.replace("# ", ""), level=1)
-        elif line.lstrip().startswith(("- ", "* ")):
-            doc.add_paragraph(line.lstrip()[2:], style="List Bullet")
-        else:
-            doc.add_paragraph(line)
+    # Insert ahead of the trailing section properties, as add_paragraph does.
+    body = doc.element.body
+    sect_pr = body.sectPr
+    at = body.index(sect_pr) if sect_pr is not None else len(body)
+    body[at:at] = list(fragment)
 
-    import io
     buf = io.BytesIO()
     doc.save(buf)
     return buf.getvalue()
 
+@st.cache_resource(show_spinner=False, max_entries=64)
+def _md_to_docx_cached(md_text: str) -> bytes:
+    # cache_resource hands back the same immutable bytes object to every
+    # session instead of unpickling a copy per hit like cache_data.
+    return markdown_to_docx(md_text)
+
 # =========================================================
 # Session init
 # =========================================================
 st.set_page_config(page_title="Discovery Intelligence Report Generator", layout="wide")
 
 st.session_state.setdefault("report_md", "")
+st.session_state.setdefault("report_variants", [])
 st.session_state.setdefault("docx_bytes", None)
+st.session_state.setdefault("_last_md_hash", None)
 st.session_state.setdefault("last_error", "")
+st.session_state.setdefault("pending_payloads", [])
+st.session_state.setdefault("batch_job", None)
 
 # =========================================================
 # Payload builder (reads current session_state)
 # =========================================================
+TRANSCRIPT_TOKEN_LIMIT = 4000
+TRANSCRIPT_DIGEST_MODEL = "gpt-4o-mini"
+TRANSCRIPT_DIGEST_SYSTEM = """Extract the facts from this meeting transcript or set of notes as a terse bullet list.
+Keep names of roles and departments, numbers, dates, KPIs, risks, constraints and direct concerns.
+Drop greetings, filler, repetition and speaker small talk. Do not add interpretation or recommendations.
+"""
+
+@st.cache_resource
+def _get_transcript_encoding():
+    import tiktoken
+    return tiktoken.encoding_for_model(TRANSCRIPT_DIGEST_MODEL)
+
+@st.cache_data(show_spinner="Summarizing long transcript...", ttl=3600, max_entries=32)
+def _digest_transcript(_client, text: str) -> str:
+    resp = get_throttle().call(
+        _client.responses.create,
+        model=TRANSCRIPT_DIGEST_MODEL,
+        input=[
+            {"role": "system", "content": TRANSCRIPT_DIGEST_SYSTEM},
+            {"role": "user", "content": text},
+        ],
+        temperature=0,
+    )
+    return resp.output_text
+
+def _maybe_compress_transcript(text: str) -> str:
+    # Byte-level BPE: a token never covers less than one UTF-8 byte, so short
+    # texts skip tokenizing.
+    if len(text.encode("utf-8")) <= TRANSCRIPT_TOKEN_LIMIT:
+        return text
+    if len(_get_transcript_encoding().encode(text)) <= TRANSCRIPT_TOKEN_LIMIT:
+        return text
+    return _digest_transcript(get_client(), text)
+
+# (payload field, session_state key) for each structured input
+_STRUCT_KEYS = (
+    ("project_objective", "objective"),
+    ("why_initiated_problem_trigger", "why_now"),
+    ("benefiting_departments", "beneficiaries"),
+    ("impacted_people", "impacted_people"),
+    ("kpi_burden", "kpis"),
+    ("if_not_done_consequences", "constraints_if_not_done"),
+    ("internal_challenges", "internal_challenges"),
+    ("org_changes", "org_changes"),
+    ("ceo_info", "ceo_info"),
+    ("previous_ceo_problems", "prior_ceo_issues"),
+    ("why_external_vendor", "vendor_reason"),
+    ("why_not_listening_internally", "listening_issue"),
+    ("ownership_and_misalignment", "ownership_misalignment"),
+    ("contracts_dependencies", "contracts"),
+    ("ma_and_culture", "ma_history"),
+    ("budget_duration_payment", "budget_duration_payment"),
+    ("long_term_vision_and_next", "long_term"),
+)
+
 def build_payload_from_state():
     include_open_questions = st.session_state.get("include_open_questions", True)
+    transcript = clean_text(st.session_state.get("transcript", ""))
+    if st.session_state.get("compress_transcript", False):
+        transcript = _maybe_compress_transcript(transcript)
     payload = {
         "client_name": clean_text(st.session_state.get("client_name", "")) or "Client",
         "meeting_type": st.session_state.get("meeting_type", "Discovery / Intake"),
         "project_name": clean_text(st.session_state.get("project_name", "")),
-        "transcript_or_notes": clean_text(st.session_state.get("transcript", "")),
+        "transcript_or_notes": transcript,
         "structured_inputs": {
-            "project_objective": clean_text(st.session_state.get("objective", "")),
-            "why_initiated_problem_trigger": clean_text(st.session_state.get("why_now", "")),
-            "benefiting_departments": clean_text(st.session_state.get("beneficiaries", "")),
-            "impacted_people": clean_text(st.session_state.get("impacted_people", "")),
-            "kpi_burden": clean_text(st.session_state.get("kpis", "")),
-            "if_not_done_consequences": clean_text(st.session_state.get("constraints_if_not_done", "")),
-            "internal_challenges": clean_text(st.session_state.get("internal_challenges", "")),
-            "org_changes": clean_text(st.session_state.get("org_changes", "")),
-            "ceo_info": clean_text(st.session_state.get("ceo_info", "")),
-            "previous_ceo_problems": clean_text(st.session_state.get("prior_ceo_issues", "")),
-            "why_external_vendor": clean_text(st.session_state.get("vendor_reason", "")),
-            "why_not_listening_internally": clean_text(st.session_state.get("listening_issue", "")),
-            "ownership_and_misalignment": clean_text(st.session_state.get("ownership_misalignment", "")),
-            "contracts_dependencies": clean_text(st.session_state.get("contracts", "")),
-            "ma_and_culture": clean_text(st.session_state.get("ma_history", "")),
-            "budget_duration_payment": clean_text(st.session_state.get("budget_duration_payment", "")),
-            "long_term_vision_and_next": clean_text(st.session_state.get("long_term", "")),
+            dst: (st.session_state.get(src) or "").strip() for dst, src in _STRUCT_KEYS
         },
         "report_constraints": {
             "no_solutions": True,
@@ -167,33 +845,104 @@ def build_payload_from_state():
 # =========================================================
 # Generation (called from Output tab)
 # =========================================================
-def run_generation_from_output():
+EMPTY_INPUTS_ERROR = "Please paste at least a transcript/notes OR fill at least one structured field."
+
+def payload_is_empty(payload: dict) -> bool:
+    return not payload["transcript_or_notes"] and all(not v for v in payload["structured_inputs"].values())
+
+def run_generation_from_output(stream_to=None):
     try:
         payload = build_payload_from_state()
 
-        if not payload["transcript_or_notes"] and all(not v for v in payload["structured_inputs"].values()):
-            st.session_state["last_error"] = "Please paste at least a transcript/notes OR fill at least one structured field."
+        if payload_is_empty(payload):
+            st.session_state["last_error"] = EMPTY_INPUTS_ERROR
             st.session_state["report_md"] = ""
+            st.session_state["report_variants"] = []
             st.session_state["docx_bytes"] = None
             return
 
         st.session_state["last_error"] = ""
 
-        report_md = generate_report(payload)
+        if st.session_state.get("generate_variants", False):
+            # Not streamed (n > 1), so show progress while all drafts complete.
+            with st.spinner("Generating 3 variants..."):
+                variants = generate_report_variants(payload, n_variants=3)
+            report_md = variants[0]
+        elif st.session_state.get("reuse_similar_reports", False):
+            variants = []
+            report_md = get_semantic_cache().get_or_generate(payload, stream_to=stream_to)
+        else:
+            variants = []
+            report_md = generate_report(payload, stream_to=stream_to)
+        st.session_state["report_variants"] = variants
+        st.session_state["selected_variant"] = 0
         st.session_state["report_md"] = report_md
 
-        if st.session_state.get("include_docx", True):
-            st.session_state["docx_bytes"] = markdown_to_docx(report_md)
-        else:
-            st.session_state["docx_bytes"] = None
+    except ReportIncompleteError as e:
+        # Keep the partial text on screen, but flag it (it is not cached).
+        st.session_state["last_error"] = str(e)
+        st.session_state["report_md"] = e.report
+        st.session_state["report_variants"] = []
 
     except Exception as e:
         st.session_state["last_error"] = f"Generation failed: {e}"
         st.session_state["report_md"] = ""
+        st.session_state["report_variants"] = []
         st.session_state["docx_bytes"] = None
 
+def _md_hash(report_md: str) -> bytes:
+    return hashlib.blake2b(report_md.encode("utf-8"), digest_size=16).digest()
+
+def docx_is_current(report_md: str) -> bool:
+    return bool(st.session_state.get("docx_bytes")) and st.session_state.get("_last_md_hash") == _md_hash(report_md)
+
+def prepare_docx():
+    # DOCX is built on demand; most users only read the markdown.
+    report_md = st.session_state.get("report_md", "")
+    if not report_md or docx_is_current(report_md):
+        return
+    try:
+        st.session_state["docx_bytes"] = _md_to_docx_cached(report_md)
+        st.session_state["_last_md_hash"] = _md_hash(report_md)
+    except Exception as e:
+        st.session_state["last_error"] = f"DOCX export failed: {e}"
+
+def select_variant():
+    variants = st.session_state.get("report_variants", [])
+    index = st.session_state.get("selected_variant", 0)
+    if index < len(variants):
+        st.session_state["report_md"] = variants[index]
+
+def queue_for_batch():
+    try:
+        # May call the API when long transcripts are summarized first.
+        payload = build_payload_from_state()
+    except Exception as e:
+        st.session_state["last_error"] = f"Queueing failed: {e}"
+        return
+    if payload_is_empty(payload):
+        st.session_state["last_error"] = EMPTY_INPUTS_ERROR
+        return
+    st.session_state["last_error"] = ""
+    st.session_state["pending_payloads"].append(payload)
+
+def run_batch():
+    pending = st.session_state["pending_payloads"]
+    if not pending:
+        return
+    try:
+        items = [(p["client_name"], build_inputs(p)) for p in pending]
+        job = BatchJob(get_client(), get_model(), items)
+        job.submit()
+        st.session_state["batch_job"] = job
+        st.session_state["pending_payloads"] = []
+        st.session_state["last_error"] = ""
+    except Exception as e:
+        st.session_state["last_error"] = f"Batch submission failed: {e}"
+
 def clear_report():
     st.session_state["report_md"] = ""
+    st.session_state["report_variants"] = []
     st.session_state["docx_bytes"] = None
     st.session_state["last_error"] = ""
 
@@ -203,7 +952,12 @@ def clear_report():
 st.title("Discovery Intelligence Report Generator (Streamlit)")
 st.caption("Turn messy discovery notes into a premium executive-ready report (no solutions).")
 
-with st.sidebar:
+def _exclusive_with(key: str, other: str):
+    # Variants are always sampled fresh, so the two modes can't be combined.
+    if st.session_state.get(key):
+        st.session_state[other] = False
+
+def _sidebar_settings():
     st.header("Settings")
     st.write(f"Model: `{get_model()}`")
     st.slider("Tone (Neutral ↔ Strong)", 0, 10, 3, key="tone")
@@ -211,13 +965,42 @@ with st.sidebar:
     st.subheader("Quality checks")
     st.checkbox("Include 'Open Questions & Data Needed' section", value=True, key="include_open_questions")
     st.checkbox("Enable DOCX download", value=True, key="include_docx")
-
-tab1, tab2 = st.tabs(["Input", "Output"])
+    st.checkbox(
+        "Reuse similar prior reports",
+        value=False,
+        key="reuse_similar_reports",
+        on_change=_exclusive_with,
+        args=("reuse_similar_reports", "generate_variants"),
+        help="Not available together with 'Generate 3 variants'.",
+    )
+    st.checkbox(
+        "Generate 3 variants",
+        value=False,
+        key="generate_variants",
+        on_change=_exclusive_with,
+        args=("generate_variants", "reuse_similar_reports"),
+        help="Drafts are always freshly generated; turns off 'Reuse similar prior reports'.",
+    )
+    st.checkbox(
+        "Summarize long transcript first",
+        value=False,
+        key="compress_transcript",
+        help=f"Transcripts over {TRANSCRIPT_TOKEN_LIMIT} tokens are condensed with {TRANSCRIPT_DIGEST_MODEL} before the report call.",
+    )
+    st.checkbox(
+        "Compress large API requests (gzip)",
+        value=False,
+        key="gzip_requests",
+        help=f"Gzips request bodies over {GZIP_MIN_BYTES // 1024} KB; falls back to uncompressed if the API rejects them.",
+    )
 
 # -----------------------------
 # Input tab (only collects inputs)
+# Widget edits rerun just this fragment; the Output tab reads the values
+# from st.session_state when Generate is clicked.
 # -----------------------------
-with tab1:
+@st.fragment
+def _input_tab():
     st.subheader("Client & meeting info")
     colA, colB, colC = st.columns(3)
     with colA:
@@ -277,26 +1060,51 @@ with tab1:
 # -----------------------------
 # Output tab (Generate/Refresh lives here)
 # -----------------------------
-with tab2:
+@st.fragment
+def _output_tab():
     st.subheader("Generated report")
 
-    colX, colY, colZ = st.columns([1.2, 1.0, 2.8])
+    colX, colQ, colY, colZ = st.columns([1.2, 1.0, 1.0, 1.8])
     with colX:
-        st.button("Generate / Refresh report", type="primary", on_click=run_generation_from_output)
+        generate_clicked = st.button("Generate / Refresh report", type="primary")
+    with colQ:
+        st.button("Queue for batch", on_click=queue_for_batch)
     with colY:
         st.button("Clear report", on_click=clear_report)
     with colZ:
         st.caption("Tip: update inputs in the Input tab, then click **Generate/Refresh** here.")
 
+    error_slot = st.empty()
+    report_slot = st.empty()
+
+    if generate_clicked:
+        run_generation_from_output(stream_to=report_slot.container())
+
     if st.session_state.get("last_error"):
-        st.error(st.session_state["last_error"])
+        error_slot.error(st.session_state["last_error"])
 
     report_md = st.session_state.get("report_md", "")
+    variants = st.session_state.get("report_variants", [])
     if not report_md:
-        st.info("No report yet. Click **Generate / Refresh report** above.")
+        report_slot.info("No report yet. Click **Generate / Refresh report** above.")
+    elif len(variants) > 1:
+        with report_slot.container():
+            for tab, variant in zip(st.tabs([f"Variant {i + 1}" for i in range(len(variants))]), variants):
+                with tab:
+                    st.markdown(variant)
+            st.radio(
+                "Variant to download",
+                options=list(range(len(variants))),
+                format_func=lambda i: f"Variant {i + 1}",
+                horizontal=True,
+                key="selected_variant",
+                on_change=select_variant,
+            )
     else:
-        st.markdown(report_md)
+        report_slot.markdown(report_md)
 
+    # Downloads follow report_md, which select_variant keeps on the picked variant.
+    if report_md:
         colD, colE = st.columns(2)
         with colD:
             st.download_button(
@@ -306,10 +1114,53 @@ with tab2:
                 mime="text/markdown",
             )
         with colE:
-            if st.session_state.get("docx_bytes"):
+            if st.session_state.get("include_docx", True):
+                if docx_is_current(report_md):
+                    st.download_button(
+                        "Download DOCX",
+                        data=st.session_state["docx_bytes"],
+                        file_name="discovery_intelligence_report.docx",
+                        mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+                    )
+                else:
+                    st.button("Prepare DOCX", on_click=prepare_docx)
+
+    # -----------------------------
+    # Batch mode (OpenAI Batch API)
+    # -----------------------------
+    pending = st.session_state.get("pending_payloads", [])
+    job = st.session_state.get("batch_job")
+    if pending or job is not None:
+        st.divider()
+        st.subheader("Batch mode")
+
+    if pending:
+        st.write(f"Queued for batch: {', '.join(p['client_name'] for p in pending)}")
+        st.button(f"Run batch ({len(pending)})", on_click=run_batch)
+
+    if job is not None:
+        st.caption(f"Batch `{job.batch_id}`: {job.status}. Results can take up to 24h.")
+        if job.error:
+            st.warning(f"Could not check batch status (the batch itself may still be running): {job.error}")
+        st.button("Refresh batch status")
+        st.dataframe(job.progress_rows(), hide_index=True, use_container_width=True)
+        for custom_id, report in list(job.results.items()):
+            label = job.items[int(custom_id)][0]
+            with st.expander(f"{custom_id}: {label}"):
+                st.markdown(report)
                 st.download_button(
-                    "Download DOCX",
-                    data=st.session_state["docx_bytes"],
-                    file_name="discovery_intelligence_report.docx",
-                    mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+                    "Download Markdown",
+                    data=report.encode("utf-8"),
+                    file_name=f"discovery_intelligence_report_{custom_id}.md",
+                    mime="text/markdown",
+                    key=f"batch_md_{custom_id}",
                 )
+
+with st.sidebar:
+    _sidebar_settings()
+
+tab1, tab2 = st.tabs(["Input", "Output"])
+with tab1:
+    _input_tab()
+with tab2:
+    _output_tab()